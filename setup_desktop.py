@@ -12,7 +12,10 @@ TODO:
 """
 
 import argparse
+import functools
+import os
 from pathlib import Path
+import shutil
 import subprocess
 import urllib.request
 
@@ -41,6 +44,14 @@ APP_PKGS = [
 
 PACKAGES = DEV_PKGS + UTIL_PKGS + APP_PKGS
 
+# keep apt quiet and non-interactive, terminal output slows installs down
+APT_ENV = {
+    **os.environ,
+    "DEBIAN_FRONTEND": "noninteractive",
+    "APT_LISTCHANGES_FRONTEND": "none",
+}
+APT_FLAGS = ["-qq", "-o", "Dpkg::Use-Pty=0", "-o", "Dpkg::Options::=--force-confold"]
+
 PPAS = [
     # Nvidia drivers
     "ppa:graphics-drivers/ppa"
@@ -68,42 +79,113 @@ def update_drivers():
     print("Update drivers")
     subprocess.run(["sudo", "ubuntu-drivers", "autoinstall"], check=True)
 
+def configured_sources():
+    """ Active (not commented out or disabled) apt sources under sources.list.d """
+    sources_dir = Path("/etc/apt/sources.list.d")
+    active = []
+    for f in sources_dir.glob("*.list"):
+        active += [line for line in f.read_text(errors="ignore").splitlines()
+                   if line.lstrip().startswith("deb")]
+    for f in sources_dir.glob("*.sources"):
+        # deb822 format, one stanza per blank-line separated block
+        for stanza in f.read_text(errors="ignore").split("\n\n"):
+            lines = [line.strip() for line in stanza.splitlines()
+                     if not line.lstrip().startswith("#")]
+            fields = dict(line.split(":", 1) for line in lines if ":" in line)
+            if fields.get("Enabled", "yes").strip().lower() != "no":
+                active += lines
+    return "\n".join(active)
+
 def add_ppas():
-    """ Add our PPAs, and only update cache at the end """
+    """ Add missing PPAs, and only update cache at the end if anything was added """
     print("Adding PPAs")
+    sources = configured_sources()
+    added = False
     for ppa in PPAS:
+        # ppa:owner/name is served from .../owner/name/ubuntu
+        if ppa.split(":", 1)[1] + "/ubuntu" in sources:
+            continue
         subprocess.run(
                 ["sudo", "add-apt-repository", "-y", "--no-update", ppa],
                 check=True)
-    subprocess.run(["sudo", "apt", "update"], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        added = True
+    if added:
+        subprocess.run(
+                ["sudo", "-E", "apt-get", "update", "-o", "Acquire::Languages=none",
+                 "-o", "APT::Get::List-Cleanup=0"] + APT_FLAGS,
+                env=APT_ENV, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 def install_packages(packages=PACKAGES):
     print("Installing Packages: ", packages)
-    subprocess.run(["sudo", "apt", "install", "-y"] + packages, check=True)
+    subprocess.run(
+            ["sudo", "-E", "apt-get", "install", "-y", "--no-install-recommends"]
+            + APT_FLAGS + packages,
+            env=APT_ENV, check=True, stdout=subprocess.DEVNULL)
+
+def start_download(packages=PACKAGES):
+    """ Fetch packages into the apt cache in the background, returns the Popen to wait on """
+    print("Downloading Packages: ", packages)
+    return subprocess.Popen(
+            ["sudo", "-E", "apt-get", "install", "-y", "--download-only",
+             "--no-install-recommends"] + APT_FLAGS + packages,
+            env=APT_ENV, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+@functools.lru_cache(maxsize=1)
+def _installed_set():
+    """ Snapshot of installed packages from a single dpkg-query call """
+    p = subprocess.run(
+            ["dpkg-query", "-W", "-f=${Package}\t${Status}\n"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    rows = (line.split("\t", 1) for line in p.stdout.splitlines())
+    # status is "<want> <flag> <state>", e.g. held packages are "hold ok installed"
+    return {pkg for pkg, status in rows if status.split()[-1:] == ["installed"]}
 
 def is_installed(package_name):
-    p = subprocess.run(["dpkg", "-l", package_name], stdout=subprocess.DEVNULL, timeout=0.05)
-    return p.returncode == 0
-
-def install_nautilus():
-    print("Ensure Dropbox installed")
-    if not is_installed("nautilus-dropbox"):
-        install_packages(packages=["nautilus-dropbox"])
-        # trigger dropbox setup
-        subprocess.run(["nautilus", "--quit"])
+    return package_name in _installed_set()
 
 def change_display_settings():
+    """ Apply all UI tweaks with a single dconf load instead of one gsettings call each """
     print("Updating display settings")
-    for tweak in UI_TWEAKS:
-        subprocess.run(["gsettings", "set"] + tweak, check=True)
-
-def install_chrome():
-    """ Because 1password does not yet support Firefox"""
+    sections = {}
+    for schema, key, value in UI_TWEAKS:
+        sections.setdefault(schema.replace(".", "/"), []).append(f"{key}={value}")
+    keyfile = "\n".join(
+            f"[{path}]\n" + "\n".join(entries) + "\n"
+            for path, entries in sections.items())
+    subprocess.run(["dconf", "load", "/"], input=keyfile, text=True, check=True)
+
+def download_chrome():
+    """ Because 1password does not yet support Firefox
+
+    Returns path of the downloaded .deb, or None if chrome is already installed
+    """
     print("Ensure google chrome and 1Password installed")
-    if not is_installed("google-chrome-stable"):
-        deb_file = "/tmp/chrome.deb"
-        urllib.request.urlretrieve("https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb", deb_file)
-        install_packages([deb_file])
+    if is_installed("google-chrome-stable"):
+        return None
+    deb_file = "/tmp/chrome.deb"
+    url = "https://dl.google.com/linux/direct/google-chrome-stable_current_amd64.deb"
+    with urllib.request.urlopen(url, timeout=60) as r, open(deb_file, "wb") as f:
+        shutil.copyfileobj(r, f, length=1 << 20)
+    return deb_file
+
+def install_all(chrome_deb=None):
+    """ Install PACKAGES, Dropbox and Chrome in a single apt transaction
+
+    chrome_deb is the path returned by download_chrome, if chrome needs installing
+    """
+    pkgs = list(PACKAGES)
+    # nautilus-dropbox is part of APP_PKGS, only its first-run setup is conditional
+    new_dropbox = not is_installed("nautilus-dropbox")
+    if chrome_deb:
+        pkgs.append(chrome_deb)
+
+    install_packages(pkgs)
+
+    if new_dropbox:
+        # trigger dropbox setup
+        subprocess.run(["nautilus", "--quit"])
+    if chrome_deb:
         subprocess.run(["google-chrome", "https://chrome.google.com/webstore/detail/1password-extension-deskt/aomjjhallfgjeglblehebfpbcfeobpgk?hl=en"])
 
 def set_dock_apps():
@@ -115,11 +197,12 @@ def setup_github_keys():
     key_path = Path.home().joinpath(".ssh", filename)
     if not key_path.exists():
         subprocess.run(
-            f"ssh-keygen -t rsa -b 4096 -C desktop-github -f $HOME/.ssh/{filename}",
-            shell=True)
+            ["ssh-keygen", "-t", "rsa", "-b", "4096", "-C", "desktop-github", "-f", str(key_path)],
+            check=True)
         print(f"Add {key_path} public key to Github account")
     else:
-        subprocess.run(f"xclip -sel clip < $HOME/.ssh/{filename}.pub", shell=True)
+        with open(f"{key_path}.pub", "rb") as pub_key:
+            subprocess.run(["xclip", "-sel", "clip"], stdin=pub_key, check=True)
 
 def setup_symlinks():
     print("Setting up symlinks")
@@ -129,9 +212,14 @@ def setup_symlinks():
 if __name__=="__main__":
     add_ppas()
     update_drivers()
-    install_nautilus()
-    install_chrome()
-    install_packages()
-    change_display_settings()
+    # overlap the apt download with the chrome download and other setup that
+    # does not touch apt, the install afterwards then only unpacks from the cache
+    download = start_download()
+    try:
+        chrome_deb = download_chrome()
+        change_display_settings()
+    finally:
+        download.wait()
+    install_all(chrome_deb)
     setup_github_keys()
     setup_symlinks()
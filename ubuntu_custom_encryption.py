@@ -17,12 +17,13 @@ TODO:
 """
 import argparse
 import difflib
-import json
+import functools
 import os
-from pathlib import Path
-from pprint import pprint
+import re
+import shlex
 import subprocess
 import sys
+import tempfile
 
 
 # One-to-one mapping to our Physical Devices and Volume Group
@@ -31,7 +32,8 @@ LUKS_DEVICES = {
     "/dev/sda5": "system",
     "/dev/sdb3": "data"
 }
-LUKS_NAME_MAP = dict([(value, key) for key, value in LUKS_DEVICES.items()])
+LUKS_ITEMS = tuple(LUKS_DEVICES.items())
+LUKS_NAME_MAP = {value: key for key, value in LUKS_ITEMS}
 
 
 VOLUME_GROUPS = {
@@ -71,6 +73,24 @@ LOGICAL_VOLUMES = {
         }
 }
 
+# files we install into the new system
+CRYPTTAB_PATH = "/mnt/root/etc/crypttab"
+GRUB_PATH = "/mnt/root/etc/default/grub"
+GET_INIT_PATH = "/mnt/root/lib/cryptsetup/scripts/getinitramfskey.sh"
+LOAD_INIT_PATH = "/mnt/root/initramfs-tools/hooks/loadinitramfskey.sh"
+REFRESHGRUB_PATH = "/mnt/root/usr/local/sbin/refreshgrub"
+
+# boot entry startup.nsh must point at
+STARTUP_EFI = "\\EFI\\ubuntu\\grubx64.efi"
+
+# grub settings we rewrite, matched against the start of each line
+GRUB_PATTERN = re.compile(
+        r"^(GRUB_HIDDEN_TIMEOUT=0|GRUB_HIDDEN_TIMEOUT_QUIET=true|GRUB_ENABLE_CRYPTODISK=y)")
+GRUB_REPLACEMENTS = {
+        "GRUB_HIDDEN_TIMEOUT=0": "#GRUB_HIDDEN_TIMEOUT=0\n",
+        "GRUB_HIDDEN_TIMEOUT_QUIET=true": "GRUB_HIDDEN_TIMEOUT_QUIET=false\n",
+}
+
 GET_INIT_SCRIPT = """
 # File:
 #       /lib/cryptsetup/scripts/getinitramfskey.sh
@@ -195,7 +215,13 @@ update-initramfs -ck all
 echo 'Successfully refreshed Grub.'
 """
 
+# file payloads, written as-is by fix_chroot_stuff
+GET_INIT_BYTES = GET_INIT_SCRIPT.strip().encode()
+LOAD_INIT_BYTES = LOAD_INIT_SCRIPT.strip().encode()
+REFRESHGRUB_BYTES = REFRESHGRUB.strip().encode()
 
+
+@functools.lru_cache(maxsize=None)
 def expected_partitions():
     partitions = """
 BYT;
@@ -228,6 +254,37 @@ def query_yes_no(question):
             sys.stdout.write("Please respond with 'y' or 'n'\n")
 
 
+def run_probes(commands, **kwargs):
+    """
+    Run independent, read-only commands concurrently.
+
+    Spawns every command up front, then reaps them in one pass.
+    Stderr of any failing probe is printed, since failures usually lead to a create.
+    Returns the CompletedProcess of each command, in the same order.
+    """
+    kwargs.setdefault("stdout", subprocess.DEVNULL)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    procs = []
+    try:
+        for c in commands:
+            procs.append(subprocess.Popen(c, **kwargs))
+        results = []
+        for p in procs:
+            stdout, stderr = p.communicate()
+            if p.returncode != 0 and stderr:
+                print(stderr.decode() if isinstance(stderr, bytes) else stderr,
+                        end="", file=sys.stderr)
+            results.append(subprocess.CompletedProcess(p.args, p.returncode, stdout, stderr))
+        return results
+    finally:
+        # never leave children behind, e.g. when a later Popen fails
+        for p in procs:
+            for pipe in (p.stdout, p.stderr):
+                if pipe:
+                    pipe.close()
+            p.wait()
+
+
 def check_partitions():
     """
     Check current partitions against expectations.
@@ -242,11 +299,13 @@ def check_partitions():
             encoding="utf-8")
 
     current_partitions = "\n\n".join(p.stdout.split("\n\n")[:2]) + "\n"
-    diff = list(difflib.unified_diff(
-        expected_partitions().splitlines(1), 
-        current_partitions.splitlines(1), 
-        fromfile="expected", tofile="current", lineterm="\n"))
-    if diff:
+    expected = expected_partitions()
+    if expected != current_partitions:
+        # only pay for the diff when we have something to show
+        diff = difflib.unified_diff(
+            expected.splitlines(True),
+            current_partitions.splitlines(True),
+            fromfile="expected", tofile="current", lineterm="\n")
         for line in diff:
             print(f"{line}", end="")
         print()
@@ -261,8 +320,8 @@ def check_partitions():
 def setup_luks():
     # make sure we have luks volumes and that they look reasonable
     is_luks = ["sudo", "cryptsetup", "isLuks"]
-    for device, name in LUKS_DEVICES.items():
-        p = subprocess.run(is_luks + [device])
+    probes = run_probes([is_luks + [device] for device in LUKS_DEVICES])
+    for (device, name), p in zip(LUKS_ITEMS, probes):
         if p.returncode == 0:
             print(f"Device {device} is already a LUKS volume")
             if VERBOSE:
@@ -277,21 +336,22 @@ def open_luks():
     # now open them
     open_luks = ["sudo", "cryptsetup", "luksOpen"]
     is_open = ["sudo", "dmsetup", "info"]
-    for device, name in LUKS_DEVICES.items():
-        p = subprocess.run(is_open + [name], stdout=subprocess.PIPE, encoding='utf-8')
-        if p.returncode != 0 or "ACTIVE" not in p.stdout:
+    probes = run_probes([is_open + [name] for name in LUKS_DEVICES.values()],
+            stdout=subprocess.PIPE)
+    for (device, name), p in zip(LUKS_ITEMS, probes):
+        if p.returncode != 0 or b"ACTIVE" not in p.stdout:
             print(f"Opening {device} ({name})")
             subprocess.run(open_luks + [device, name])
         else:
             print(f"Luks device {device} opened as {name}")
             if VERBOSE:
-                print(p.stdout)
+                print(p.stdout.decode())
 
 
 def check_physical_volumes():
-    for name in LUKS_DEVICES.values():
-        device = f"/dev/mapper/{name}"
-        p = subprocess.run(["sudo", "pvs", device])
+    devices = [f"/dev/mapper/{name}" for name in LUKS_DEVICES.values()]
+    probes = run_probes([["sudo", "pvs", device] for device in devices])
+    for device, p in zip(devices, probes):
         if p.returncode == 0:
             print(f"Physical volume {device} already exists")
         else:
@@ -299,8 +359,8 @@ def check_physical_volumes():
 
 
 def check_volume_groups():
-    for name, physical_volumes in VOLUME_GROUPS.items():
-        p = subprocess.run(["sudo", "vgs", name])
+    probes = run_probes([["sudo", "vgs", name] for name in VOLUME_GROUPS])
+    for (name, physical_volumes), p in zip(VOLUME_GROUPS.items(), probes):
         if p.returncode == 0:
             print(f"Volume group {name} already exists")
         else:
@@ -312,54 +372,74 @@ def check_volume_groups():
 
 
 def check_logical_volumes():
+    volumes = [
+        (volume_group, volume_name, volume_data,
+            f"/dev/mapper/{volume_group}-{volume_name}")
+        for volume_group, data in LOGICAL_VOLUMES.items()
+        for volume_name, volume_data in data.items()
+    ]
 
+    # create logical volumes, in order since later ones take the free extents
     lvs_exists = ["sudo", "lvs"]
-    for volume_group, data in LOGICAL_VOLUMES.items():
-        for volume_name, volume_data in data.items():
-            # create logical volume
-            logical_volume = f"/dev/mapper/{volume_group}-{volume_name}"
-            p = subprocess.run(lvs_exists + [logical_volume])
-            if p.returncode == 0:
-                print(f"Logical Volume {logical_volume} already exists!")
-            else:
-                subprocess.run(["sudo", "lvcreate"] + 
-                                volume_data['size'] + 
-                                [f"--name={volume_name}", volume_group])
-            # create filesystem
-            p = subprocess.run(["sudo", "blkid", "-s", "TYPE", logical_volume],
-                    stdout=subprocess.PIPE, encoding='utf-8')
-            if volume_data['type'] not in p.stdout:
-                command = ["sudo"] + volume_data['filesystem_command'] + [ logical_volume]
-                print(" ".join(command))
-                subprocess.run(command)
-            else:
-                print(f"Logical volume {logical_volume} already defines filesystem of type {volume_data['type']}")
+    probes = run_probes([lvs_exists + [lv] for _, _, _, lv in volumes])
+    for (volume_group, volume_name, volume_data, logical_volume), p in zip(volumes, probes):
+        if p.returncode == 0:
+            print(f"Logical Volume {logical_volume} already exists!")
+        else:
+            subprocess.run(["sudo", "lvcreate"] + 
+                            volume_data['size'] + 
+                            [f"--name={volume_name}", volume_group])
+
+    # create filesystems
+    probes = run_probes([["sudo", "blkid", "-s", "TYPE", lv] for _, _, _, lv in volumes],
+            stdout=subprocess.PIPE)
+    for (_, _, volume_data, logical_volume), p in zip(volumes, probes):
+        if volume_data['type'].encode() not in p.stdout:
+            command = ["sudo"] + volume_data['filesystem_command'] + [ logical_volume]
+            print(" ".join(command))
+            subprocess.run(command)
+        else:
+            print(f"Logical volume {logical_volume} already defines filesystem of type {volume_data['type']}")
 
 def mount_partitions():
-    commands = [
-        "sudo mkdir /mnt/root",
-        "sudo mount /dev/mapper/system-root /mnt/root",
-        "sudo mount /dev/mapper/system-boot /mnt/root/boot",
-        "sudo mount /dev/sda2 /mnt/root/boot/efi",
-        "sudo mount /dev/mapper/data-home /mnt/root/home"
+    # order matters, mount --all works through the file top to bottom
+    mounts = [
+        ("/dev/mapper/system-root", "/mnt/root"),
+        ("/dev/mapper/system-boot", "/mnt/root/boot"),
+        ("/dev/sda2", "/mnt/root/boot/efi"),
+        ("/dev/mapper/data-home", "/mnt/root/home"),
     ]
-    for c in commands:
-        print("DOING:", c)
-        subprocess.run(c.split())
-        print("DONE")
+    with tempfile.NamedTemporaryFile("w", suffix=".fstab", delete=False) as f:
+        fstab = f.name
+        for device, mountpoint in mounts:
+            # let mount detect the filesystem type
+            f.write(f"{device} {mountpoint} auto defaults 0 0\n")
+
+    try:
+        print("Mounting partitions under /mnt/root")
+        subprocess.run(["sudo", "mkdir", "-p", "/mnt/root"], check=True)
+        subprocess.run(["sudo", "mount", "--all", "--fstab", fstab], check=True)
+    finally:
+        os.remove(fstab)
 
 def create_key_files():
     key_files = [
             ["/mnt/root/etc/crypt.system", 'system'],
             ["/mnt/root/etc/crypt.data", 'data']
             ]
-    for key, luks_name in key_files:
-        if not os.path.exists(key):
-            partition = LUKS_NAME_MAP[luks_name]
-            p =subprocess.run(["sudo", "dd", "if=/dev/urandom", f"of={key}", "count=1", "bs=512"])
-            print(f"Enter passphrase for luks device {luks_name}")
-            p = subprocess.run(["sudo", "cryptsetup", "luksAddKey", partition, key])
-
+    missing = [(key, luks_name) for key, luks_name in key_files if not os.path.exists(key)]
+    if not missing:
+        return
+    # write all missing keys from one sudo'd shell rather than one dd process each
+    subprocess.run(["sudo", "sh", "-c", " && ".join(
+        f"dd if=/dev/urandom of={shlex.quote(key)} count=1 bs=512 status=none"
+        for key, _ in missing)], check=True)
+    for key, luks_name in missing:
+        partition = LUKS_NAME_MAP[luks_name]
+        print(f"Enter passphrase for luks device {luks_name}")
+        p = subprocess.run(["sudo", "cryptsetup", "luksAddKey", partition, key])
+
+@functools.lru_cache(maxsize=None)
 def get_luks_uuid(partition):
     p = subprocess.run(["sudo", "cryptsetup", "luksUUID", partition],
             stdout=subprocess.PIPE, encoding='UTF-8')
@@ -368,15 +448,18 @@ def get_luks_uuid(partition):
     raise RuntimeError(f"Something strange happened when fetching UUID for {partition}")
 
 def move(source, dest):
-    d = Path(dest).resolve().parent
-    subprocess.run(["sudo", "mkdir", "-p", str(d)])
-    subprocess.run(["sudo", "mv", source, dest])
-    subprocess.run(["sudo", "chown", "root:root", dest])
+    d = shlex.quote(os.path.dirname(os.path.abspath(dest)))
+    source, dest = shlex.quote(source), shlex.quote(dest)
+    # one sudo for the whole sequence
+    subprocess.run(["sudo", "sh", "-c",
+        f"mkdir -p {d} && mv {source} {dest} && chown root:root {dest}"],
+        check=True)
 
 def copy(source, dest):
-    d = Path(dest).resolve().parent
-    subprocess.run(["sudo", "mkdir", "-p", str(d)])
-    subprocess.run(["sudo", "cp", source, dest])
+    d = shlex.quote(os.path.dirname(os.path.abspath(dest)))
+    source, dest = shlex.quote(source), shlex.quote(dest)
+    subprocess.run(["sudo", "sh", "-c", f"mkdir -p {d} && cp {source} {dest}"],
+        check=True)
 
 
 def fix_crypttab():
@@ -394,30 +477,28 @@ data    UUID={data_uuid} /etc/crypt.data   luks,discard,noearly
         f.write("\n")
     
     print("Move crypttab in place")
-    move("crypttab", "/mnt/root/etc/crypttab")
+    move("crypttab", CRYPTTAB_PATH)
     print("Set permissions")
     subprocess.run("sudo chmod -rw /mnt/root/etc/crypt*", shell=True)
 
 def fix_grub():
-    grub_final = "/mnt/root/etc/default/grub"
-    subprocess.run(["sudo", "cp", grub_final, "grub"])
+    subprocess.run(["sudo", "cp", GRUB_PATH, "grub"])
     
-    with open("grub", "r") as f, open("grub_new", "w") as f2:
+    with open("grub", "r", buffering=1 << 20) as f, \
+            open("grub_new", "w", buffering=1 << 20) as f2:
         crypto_present = False
         for line in f:
-            if line.startswith("GRUB_HIDDEN_TIMEOUT=0"):
-                f2.write("#GRUB_HIDDEN_TIMEOUT=0\n")
-            elif line.startswith("GRUB_HIDDEN_TIMEOUT_QUIET=true"):
-                f2.write("GRUB_HIDDEN_TIMEOUT_QUIET=false\n")
-            elif line.startswith("GRUB_ENABLE_CRYPTODISK=y"):
-                crypto_present = True
-            else:
+            m = GRUB_PATTERN.match(line)
+            if m is None:
                 f2.write(line)
+                continue
+            crypto_present |= m.group(1) == "GRUB_ENABLE_CRYPTODISK=y"
+            f2.write(GRUB_REPLACEMENTS.get(m.group(1), line))
 
         if not crypto_present:
             f2.write("GRUB_ENABLE_CRYPTODISK=y\n")
 
-    move("grub_new", grub_final)
+    move("grub_new", GRUB_PATH)
     os.remove("grub")
             
 def fix_chroot_stuff():
@@ -434,29 +515,28 @@ mount --types=sysfs sys /sys
     query_yes_no("Enter the commands above in a separate terminal, then press Y")
 
     copy("/mnt/root/boot/efi/startup.nsh", "startup.nsh")
-    if "\\EFI\\ubuntu\\grubx64.efi" not in open("startup.nsh").read():
-        print(open("startup.nsh").read())
-        query_yes_no("In chroot, make sure /boot/efi/startup.nsh contains '\\EFI\\ubuntu\\grubx64.efi' before continuing")
+    with open("startup.nsh") as f:
+        startup = f.read()
+    if STARTUP_EFI not in startup:
+        print(startup)
+        query_yes_no(f"In chroot, make sure /boot/efi/startup.nsh contains '{STARTUP_EFI}' before continuing")
     os.remove("startup.nsh")
 
-    with open("getinitramfskey.sh", "w") as f:
-        f.write(GET_INIT_SCRIPT.strip())
-    getinit_script = "/mnt/root/lib/cryptsetup/scripts/getinitramfskey.sh"
-    move("getinitramfskey.sh", getinit_script)
-    subprocess.run(["sudo", "chmod", "+x", getinit_script])
-    
-    with open("loadinitramfskey.sh", "w") as f:
-        f.write(LOAD_INIT_SCRIPT.strip())
-    loadinit_script = "/mnt/root/initramfs-tools/hooks/loadinitramfskey.sh"
-    move("loadinitramfskey.sh", loadinit_script)
-    subprocess.run(["sudo", "chmod", "+x", loadinit_script])
-
-    with open("refreshgrub", "w") as f:
-        f.write(REFRESHGRUB.strip())
+    with open("getinitramfskey.sh", "wb") as f:
+        f.write(GET_INIT_BYTES)
+    move("getinitramfskey.sh", GET_INIT_PATH)
+    subprocess.run(["sudo", "chmod", "+x", GET_INIT_PATH])
     
-    refresh_script = "/mnt/root/usr/local/sbin/refreshgrub"
-    move("refreshgrub", refresh_script)
-    subprocess.run(["sudo", "chmod", "+x", refresh_script])
+    with open("loadinitramfskey.sh", "wb") as f:
+        f.write(LOAD_INIT_BYTES)
+    move("loadinitramfskey.sh", LOAD_INIT_PATH)
+    subprocess.run(["sudo", "chmod", "+x", LOAD_INIT_PATH])
+
+    with open("refreshgrub", "wb") as f:
+        f.write(REFRESHGRUB_BYTES)
+
+    move("refreshgrub", REFRESHGRUB_PATH)
+    subprocess.run(["sudo", "chmod", "+x", REFRESHGRUB_PATH])
 
     query_yes_no("In chroot, run $ refreshgrub")
 